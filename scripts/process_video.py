@@ -3,186 +3,604 @@
 Process a video file and generate class notes.
 
 Usage:
-    python3 process_video.py <video_path> <output_dir>
+    python3 process_video.py <video_path> <output_dir> [--full-hash]
 
 Example:
     python3 process_video.py ~/Videos/class.mp4 ~/ClassNotes
+
+Options:
+    --full-hash           Detect duplicates by hashing the whole video rather
+                          than sampling its start, middle and end
+
+Environment:
+    WHISPER_CONCURRENCY   Max parallel Whisper requests (default: 8)
+    WHISPER_HTTP2         Set to 1 to multiplex Whisper uploads over HTTP/2 (needs h2)
+    VIDEOSUM_CACHE        Set to 0 to regenerate notes instead of reusing cached ones
+    VIDEOSUM_LOCAL_WHISPER
+                          Set to 1 to transcribe locally with faster-whisper
+                          instead of the Whisper API (needs faster-whisper)
 """
 
 import sys
 import os
 import json
+import contextlib
+import functools
 import hashlib
+import importlib.util
+import queue
+import random
 import subprocess
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 
-# Load environment variables from .env.local or .env
-env_path = Path(__file__).parent.parent / '.env.local'
-if not env_path.exists():
-    env_path = Path(__file__).parent.parent / '.env'
-load_dotenv(env_path)
+# The OpenAI and Anthropic SDKs take a noticeable fraction of a second to
+# import, so they are imported where they are used. Runs that stop at the
+# duplicate check never load them.
+if TYPE_CHECKING:
+    from anthropic import Anthropic
+    from openai import OpenAI
+
+try:
+    import mutagen
+    from mutagen.mp3 import MP3
+    from mutagen.mp4 import MP4
+except ImportError:
+    # probe_audio falls back to ffprobe
+    mutagen = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: hash index updates are not serialized between runs
+    fcntl = None
+
+
+def write_text_atomic(path: Path, text: str):
+    """Write text via a temporary file and rename it into place, so readers
+    (and a crashed run) never see a partially written file."""
+    # The temp name is unique per process and thread so concurrent writers of
+    # the same file (the hash index, the caches) never share a temp file.
+    # Unlike mkstemp, open() keeps the usual umask-based permissions.
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'x') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
 
-from openai import OpenAI
-from anthropic import Anthropic
+HASH_CACHE_PATH = Path('~/.cache/videosum/hashes.json').expanduser()
+HASH_CACHE_MAX_ENTRIES = 1000
+
+
+@functools.lru_cache(maxsize=1)
+def _load_hash_cache() -> dict:
+    """Load cached file hashes, keyed on path, size and mtime."""
+    try:
+        return json.loads(HASH_CACHE_PATH.read_text())
+    except (json.JSONDecodeError, IOError):
+        return {}
 
 
 def get_file_hash(file_path: Path) -> str:
-    """Generate SHA256 hash of file for duplicate detection."""
-    sha256 = hashlib.sha256()
+    """Generate SHA256 hash of file for duplicate detection.
+
+    Hashes are cached by path, size and mtime so re-checking an unchanged
+    file skips reading it again.
+    """
+    stat = file_path.stat()
+    key = f"{file_path}:{stat.st_size}:{stat.st_mtime_ns}"
+    cache = _load_hash_cache()
+    if key in cache:
+        return cache[key]
+
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Reads in large blocks with the GIL released (Python 3.11+)
+            sha256 = hashlib.file_digest(f, 'sha256')
+        else:
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+    file_hash = sha256.hexdigest()[:16]  # First 16 chars is enough
+
+    cache[key] = file_hash
+    # Drop the oldest entries so the cache doesn't grow without bound
+    for stale_key in list(cache)[:-HASH_CACHE_MAX_ENTRIES]:
+        del cache[stale_key]
+    try:
+        HASH_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        write_text_atomic(HASH_CACHE_PATH, json.dumps(cache))
+    except IOError:
+        pass  # The cache is only an optimization
+    return file_hash
+
+
+SAMPLE_SIZE = 1 << 20
+
+
+def get_file_fingerprint(file_path: Path) -> str:
+    """Fingerprint a video for duplicate detection from its size and 1 MiB
+    samples of its start, middle and end, without reading the whole file."""
+    size = file_path.stat().st_size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=8)
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            sha256.update(chunk)
-    return sha256.hexdigest()[:16]  # First 16 chars is enough
+        for offset in (0, size // 2, max(size - SAMPLE_SIZE, 0)):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+# Duplicate detection schemes, recorded in metadata.json as hash_scheme.
+# Folders without one were hashed with full-file SHA256.
+HASH_SCHEMES = {
+    'sample-v1': get_file_fingerprint,
+    'sha256': get_file_hash,
+}
+DEFAULT_HASH_SCHEME = 'sample-v1'
+
+INDEX_FILENAME = '.hash_index.json'
+INDEX_LOCK_FILENAME = '.hash_index.lock'
+
+
+@contextlib.contextmanager
+def _index_lock(output_dir: Path):
+    """Hold an exclusive lock while reading and rewriting the hash index.
+
+    Several runs can share an output directory (uploads spawn their own
+    process alongside the queue processor), so unlocked updates could drop
+    each other's entries.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(output_dir / INDEX_LOCK_FILENAME, 'a') as lock_file:
+        # Released when the file is closed
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _load_index(output_dir: Path) -> dict:
+    """Load the {source_hash: {folder, scheme}} index, or {} if there isn't a valid one."""
+    try:
+        index = json.loads((output_dir / INDEX_FILENAME).read_text())
+    except (json.JSONDecodeError, IOError):
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    # Older indexes map hashes straight to folder names, all full SHA256
+    return {
+        file_hash: entry if isinstance(entry, dict) else {'folder': entry, 'scheme': 'sha256'}
+        for file_hash, entry in index.items()
+        if isinstance(entry, str) or (isinstance(entry, dict) and {'folder', 'scheme'} <= entry.keys())
+    }
+
 
+def _write_index(output_dir: Path, index: dict):
+    """Atomically replace the hash index so readers never see a partial file."""
+    write_text_atomic(output_dir / INDEX_FILENAME, json.dumps(index, indent=2))
+
+
+def _reconcile_index(output_dir: Path, index: dict) -> bool:
+    """Add folders missing from the index (created by older versions, restored
+    from a backup, or written before the index existed) from their
+    metadata.json. Only unindexed folders are read. Returns whether the
+    index changed."""
+    indexed = {entry['folder'] for entry in index.values()}
+    changed = False
+    # scandir returns file types with the directory listing, avoiding a stat per entry
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            # Hidden directories (.git, .Trash, ...) never hold processed videos
+            if entry.name in indexed or entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                metadata = json.loads(Path(entry.path, 'metadata.json').read_text())
+            except (json.JSONDecodeError, IOError):
+                continue
+            if isinstance(metadata, dict) and metadata.get('source_hash'):
+                index[metadata['source_hash']] = {
+                    'folder': entry.name,
+                    'scheme': metadata.get('hash_scheme', 'sha256')
+                }
+                changed = True
+    return changed
+
+
+def update_index(output_dir: Path, file_hash: str, folder: str, hash_scheme: str):
+    """Record a processed folder in the hash index."""
+    with _index_lock(output_dir):
+        index = _load_index(output_dir)
+        index[file_hash] = {'folder': folder, 'scheme': hash_scheme}
+        _write_index(output_dir, index)
+
+
+def _find_in_index(output_dir: Path, index: dict, video_path: Path, hashes: dict) -> tuple[Path, str] | None:
+    """Look the video up under every scheme used in the index, returning the
+    folder and the scheme it matched under. hashes maps scheme to the video's
+    hash and is filled in as other schemes are computed."""
+    other_schemes = {entry['scheme'] for entry in index.values()} - hashes.keys()
+    for scheme in [*hashes, *sorted(other_schemes & HASH_SCHEMES.keys())]:
+        if scheme not in hashes:
+            hashes[scheme] = HASH_SCHEMES[scheme](video_path)
+        entry = index.get(hashes[scheme])
+        # The folder may have been deleted since it was indexed
+        if entry and entry['scheme'] == scheme and (output_dir / entry['folder'] / 'metadata.json').exists():
+            return output_dir / entry['folder'], scheme
+    return None
+
+
+def check_already_processed(output_dir: Path, video_path: Path,
+                            hash_scheme: str = DEFAULT_HASH_SCHEME) -> tuple[str, Path | None]:
+    """Check if this video was already processed.
 
-def check_already_processed(output_dir: Path, file_hash: str) -> Path | None:
-    """Check if this video was already processed."""
+    Returns the video's hash under hash_scheme and the existing folder, if
+    any. Folders recorded under another scheme are checked by also hashing
+    the video with that scheme. On a miss, folders the index doesn't know
+    about are indexed before giving up.
+
+    While the library has folders from before sampled fingerprints (full
+    SHA256), every new video is also hashed in full to check against them,
+    which reads the whole file. When such a folder matches, the video's
+    hash_scheme hash is added to the index so re-checks of it stay cheap.
+    """
+    hashes = {hash_scheme: HASH_SCHEMES[hash_scheme](video_path)}
+    file_hash = hashes[hash_scheme]
     if not output_dir.exists():
+        return file_hash, None
+
+    match = _find_in_index(output_dir, _load_index(output_dir), video_path, hashes)
+    if match is None:
+        with _index_lock(output_dir):
+            index = _load_index(output_dir)
+            if _reconcile_index(output_dir, index):
+                _write_index(output_dir, index)
+        match = _find_in_index(output_dir, index, video_path, hashes)
+    if match is None:
+        return file_hash, None
+
+    existing, scheme = match
+    if scheme != hash_scheme:
+        update_index(output_dir, file_hash, existing.name, hash_scheme)
+    return file_hash, existing
+
+
+# Audio is cut into 5 minute chunks while it is extracted so they can be
+# transcribed in parallel.
+SEGMENT_SECONDS = 300
+
+FFMPEG_STDERR_TAIL = 50
+_SEGMENT_OPEN_RE = re.compile(r"Opening '(.+)' for writing")
+_DURATION_RE = re.compile(r'Duration: (\d+):(\d+):([\d.]+)')
+
+# Audio tracks in these codecs can be sent to Whisper without re-encoding,
+# copied into a container with this extension. Only mono tracks at speech
+# bitrates are copied: typical stereo ~128kbps recordings upload several times
+# the bytes of the Opus path and skip its silence removal.
+COPY_CODECS = {'aac': '.m4a', 'mp3': '.mp3'}
+COPY_MAX_BITRATE = 64_000
+AUDIO_MIME_TYPES = {'.m4a': 'audio/mp4', '.mp3': 'audio/mpeg', '.ogg': 'audio/ogg'}
+
+
+def _probe_audio_header(video_path: Path) -> tuple[str | None, int | None, int | None, float | None] | None:
+    """Read codec, bitrate, channel count and duration of an MP3/MP4 file
+    in-process with mutagen. Returns None for other containers."""
+    try:
+        media = mutagen.File(video_path)
+    except mutagen.MutagenError:
+        return None
+    if not isinstance(media, (MP3, MP4)) or not media.info.length:
         return None
-    for folder in output_dir.iterdir():
-        if folder.is_dir():
-            metadata_file = folder / 'metadata.json'
-            if metadata_file.exists():
-                try:
-                    metadata = json.loads(metadata_file.read_text())
-                    if metadata.get('source_hash') == file_hash:
-                        return folder
-                except (json.JSONDecodeError, IOError):
-                    continue
-    return None
 
+    if isinstance(media, MP3):
+        codec = 'mp3'
+    elif media.info.codec.startswith('mp4a.40'):
+        # MPEG-4 audio object types (AAC-LC, HE-AAC, ...)
+        codec = 'aac'
+    else:
+        codec = None
+    return codec, media.info.bitrate or None, getattr(media.info, 'channels', None), media.info.length
 
-def extract_audio(video_path: Path, audio_path: Path) -> float:
-    """Extract audio from video using ffmpeg. Returns duration in seconds."""
-    # Use 64kbps for better transcription quality
-    # For files > 25MB, Whisper API will reject - user should use shorter clips
-    # 64kbps * 60sec * 50min / 8 / 1024 = ~23MB (safe for ~50min videos)
-    cmd = [
-        'ffmpeg', '-i', str(video_path),
-        '-vn', '-acodec', 'mp3', '-ar', '16000', '-ac', '1', '-b:a', '64k',
-        '-y', str(audio_path)
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed: {result.stderr}")
 
-    # Get duration
+def probe_audio(video_path: Path) -> tuple[str | None, int | None, int | None, float | None]:
+    """Read the first audio stream's codec, bitrate and channel count, and the duration.
+
+    MP3 and MP4 files are read with mutagen when it is installed, which
+    avoids spawning ffprobe for the most common recordings.
+    """
+    if mutagen is not None:
+        header = _probe_audio_header(video_path)
+        if header is not None:
+            return header
+
     probe_cmd = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_path)
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name,bit_rate,channels:format=duration',
+        '-of', 'json', str(video_path)
     ]
     result = subprocess.run(probe_cmd, capture_output=True, text=True)
     if result.returncode != 0:
         raise RuntimeError(f"ffprobe failed: {result.stderr}")
-    return float(result.stdout.strip())
+    info = json.loads(result.stdout)
+    stream = (info.get('streams') or [{}])[0]
+
+    # ffprobe reports "N/A" for values it can't determine
+    def parse(value, kind):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    return (
+        stream.get('codec_name'),
+        parse(stream.get('bit_rate'), int),
+        parse(stream.get('channels'), int),
+        parse(info.get('format', {}).get('duration'), float),
+    )
 
 
-def split_audio(audio_path: Path, max_size_mb: int = 20) -> list[Path]:
-    """Split audio file into chunks under max_size_mb. Returns list of chunk paths."""
-    file_size = audio_path.stat().st_size
-    max_size = max_size_mb * 1024 * 1024
+# Opus at 12kbps with the speech-tuned VoIP mode is transparent for
+# transcription and a fraction of the size of MP3. Silences longer than
+# 2 seconds are dropped, which shrinks uploads and billed minutes.
+OPUS_ARGS = [
+    '-af', 'silenceremove=stop_periods=-1:stop_threshold=-50dB:stop_duration=2',
+    '-c:a', 'libopus', '-b:a', '12k', '-application', 'voip', '-ar', '16000', '-ac', '1',
+]
 
-    if file_size <= max_size:
-        return [audio_path]
 
-    # Get duration
-    probe_cmd = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_path)
+def segment_audio(video_path: Path, audio_dir: Path, chunk_queue: queue.Queue,
+                  codec_args: list[str], suffix: str) -> float | None:
+    """Write the audio track as SEGMENT_SECONDS chunks using ffmpeg's segment
+    muxer, putting each chunk on chunk_queue once ffmpeg has finished writing
+    it. Returns the duration reported by ffmpeg, if any."""
+    cmd = [
+        'ffmpeg', '-nostats', '-threads', '0', '-i', str(video_path),
+        '-vn', '-map', '0:a:0', *codec_args,
+        '-f', 'segment', '-segment_time', str(SEGMENT_SECONDS), '-reset_timestamps', '1',
+        '-y', str(audio_dir / f'chunk_%03d{suffix}')
     ]
-    result = subprocess.run(probe_cmd, capture_output=True, text=True)
-    duration = float(result.stdout.strip())
+    # Banners can carry metadata tags in other encodings (e.g. AVI INFO)
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               text=True, errors='replace')
+    # Only the tail of stderr is kept for error reports; the rest is just
+    # the banner and per-segment messages
+    stderr = deque(maxlen=FFMPEG_STDERR_TAIL)
+    current_chunk = None
+    duration = None
+    try:
+        for line in process.stderr:
+            stderr.append(line)
+            # The input banner reports the duration before encoding starts
+            if duration is None:
+                match = _DURATION_RE.search(line)
+                if match:
+                    hours, minutes, seconds = match.groups()
+                    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            match = _SEGMENT_OPEN_RE.search(line)
+            if match:
+                # The segment muxer closes the previous chunk before opening the next
+                if current_chunk:
+                    chunk_queue.put(current_chunk)
+                current_chunk = Path(match.group(1))
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed: {''.join(stderr)}")
+    if current_chunk:
+        chunk_queue.put(current_chunk)
+    return duration
+
+
+def extract_audio(video_path: Path, audio_dir: Path, chunk_queue: queue.Queue) -> float:
+    """Extract audio from video as Whisper-sized chunks using ffmpeg.
+
+    Mono AAC and MP3 tracks at speech bitrates are stream-copied without
+    re-encoding; anything else is re-encoded to Opus. Each chunk is put on
+    chunk_queue as soon as it is written so transcription can start while the
+    rest of the video is still being processed. chunk_queue is terminated
+    with None. Returns duration in seconds.
+    """
+    try:
+        codec, bit_rate, channels, duration = probe_audio(video_path)
 
-    # Calculate chunk duration based on file size ratio
-    num_chunks = int(file_size / max_size) + 1
-    chunk_duration = duration / num_chunks
+        if codec in COPY_CODECS and channels == 1 and bit_rate and bit_rate <= COPY_MAX_BITRATE:
+            codec_args, suffix = ['-c:a', 'copy'], COPY_CODECS[codec]
+        else:
+            codec_args, suffix = OPUS_ARGS, '.ogg'
+        segmented_duration = segment_audio(video_path, audio_dir, chunk_queue, codec_args, suffix)
+    finally:
+        chunk_queue.put(None)
 
-    print(f"  Splitting into {num_chunks} chunks ({chunk_duration/60:.1f} min each)...", file=sys.stderr)
+    duration = duration or segmented_duration
+    if duration is None:
+        raise RuntimeError(f"Could not determine duration of {video_path.name}")
+    return duration
 
-    chunks = []
-    for i in range(num_chunks):
-        start_time = i * chunk_duration
-        chunk_path = audio_path.parent / f"chunk_{i:03d}.mp3"
-
-        cmd = [
-            'ffmpeg', '-i', str(audio_path),
-            '-ss', str(start_time),
-            '-t', str(chunk_duration),
-            '-acodec', 'mp3', '-ar', '16000', '-ac', '1', '-b:a', '64k',
-            '-y', str(chunk_path)
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise RuntimeError(f"ffmpeg chunk failed: {result.stderr}")
-
-        chunks.append(chunk_path)
 
-    return chunks
+# Both SDKs already retry rate limits (429), server errors (5xx, including
+# Anthropic's 529 overloaded) and connection failures with exponential
+# backoff, honouring Retry-After. Raise their default of 2 retries rather
+# than wrapping the calls in a second retry loop.
+API_MAX_RETRIES = 5
 
 
-def transcribe_chunk(audio_path: Path, client: OpenAI) -> str:
-    """Transcribe a single audio chunk."""
-    with open(audio_path, 'rb') as f:
-        response = client.audio.transcriptions.create(
+def transcribe_chunk(audio_path: Path, client: 'OpenAI') -> str:
+    """Transcribe a single audio chunk. Transient failures are retried by the client."""
+    from openai import BadRequestError
+
+    try:
+        return client.audio.transcriptions.create(
             model='whisper-1',
-            file=f,
+            # Given a path, the SDK reads the (~1 MB) chunk once and can resend
+            # the same bytes on a retry, where an open file would need rewinding
+            file=(audio_path.name, audio_path, AUDIO_MIME_TYPES[audio_path.suffix]),
             response_format='text'
         )
-    return response
+    except BadRequestError as error:
+        # silenceremove can leave a chunk of a quiet recording with no audio,
+        # and the last segment can be a fraction of a second long
+        if error.code == 'audio_too_short':
+            return ''
+        raise
 
 
-def transcribe(audio_path: Path, progress_callback=None) -> tuple[str, float]:
-    """Transcribe audio using OpenAI Whisper API. Returns (transcript, cost)."""
-    client = OpenAI()
+@functools.lru_cache(maxsize=1)
+def whisper_client() -> 'OpenAI':
+    """Return the OpenAI client used for transcription.
 
-    # Get file size for cost estimation
-    file_size = audio_path.stat().st_size
+    The client is created once and shared, so its connection pool (and TLS
+    sessions) are reused across chunks and across videos in one process.
 
-    # Split into chunks if needed (20MB max per chunk)
-    chunks = split_audio(audio_path, max_size_mb=20)
+    The hosted Whisper API has no multi-file batch endpoint, so with
+    WHISPER_HTTP2=1 the parallel chunk uploads are instead multiplexed over
+    a single HTTP/2 connection. This needs the optional h2 package; without
+    it the default HTTP/1.1 connection pool is used.
+    """
+    from openai import DefaultHttpxClient, OpenAI
 
-    transcripts = []
-    for i, chunk_path in enumerate(chunks):
-        if progress_callback:
-            progress_callback('transcribing', f'Transcribing chunk {i+1} of {len(chunks)}...', i + 1, len(chunks))
+    if os.environ.get('WHISPER_HTTP2') == '1':
+        try:
+            return OpenAI(http_client=DefaultHttpxClient(http2=True), max_retries=API_MAX_RETRIES)
+        except ImportError:
+            print("  WHISPER_HTTP2 requires the h2 package, using HTTP/1.1", file=sys.stderr)
+    return OpenAI(max_retries=API_MAX_RETRIES)
 
-        transcript = transcribe_chunk(chunk_path, client)
-        transcripts.append(transcript)
 
-        # Clean up chunk file if it's not the original
-        if chunk_path != audio_path:
-            chunk_path.unlink()
+LOCAL_WHISPER_MODEL = 'large-v3'
+LOCAL_WHISPER_BATCH_SIZE = 16
 
-    # Combine transcripts
-    full_transcript = "\n\n".join(transcripts)
 
-    # Cost: $0.006 per minute (estimate based on file size)
-    duration_minutes = file_size / (16000 * 2 * 60)
-    cost = duration_minutes * 0.006
+def local_whisper_available() -> bool:
+    """Whether VIDEOSUM_LOCAL_WHISPER=1 and faster-whisper is installed,
+    checked without loading the model."""
+    return (os.environ.get('VIDEOSUM_LOCAL_WHISPER') == '1'
+            and importlib.util.find_spec('faster_whisper') is not None)
 
-    return full_transcript, cost
 
+@functools.lru_cache(maxsize=1)
+def local_whisper_model():
+    """Return a batched faster-whisper pipeline if VIDEOSUM_LOCAL_WHISPER=1
+    and faster-whisper is installed, otherwise None."""
+    if os.environ.get('VIDEOSUM_LOCAL_WHISPER') != '1':
+        return None
+    try:
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+    except ImportError:
+        print("  VIDEOSUM_LOCAL_WHISPER requires faster-whisper, using the Whisper API", file=sys.stderr)
+        return None
+    return BatchedInferencePipeline(model=WhisperModel(LOCAL_WHISPER_MODEL))
 
-def generate_notes(transcript: str, duration_seconds: int) -> tuple[str, float]:
-    """Generate notes using Claude. Returns (markdown_notes, cost)."""
-    client = Anthropic()
 
-    hours = int(duration_seconds // 3600)
-    minutes = int((duration_seconds % 3600) // 60)
-    duration_str = f"{hours}h {minutes}m" if hours > 0 else f"{minutes}m"
+def transcribe_chunk_locally(audio_path: Path, model) -> str:
+    """Transcribe a single audio chunk with a local faster-whisper model."""
+    segments, _ = model.transcribe(str(audio_path), batch_size=LOCAL_WHISPER_BATCH_SIZE)
+    return ''.join(segment.text for segment in segments).strip()
 
-    response = client.messages.create(
-        model='claude-sonnet-4-20250514',
-        max_tokens=8192,
-        messages=[{
-            'role': 'user',
-            'content': f"""You are analyzing a class recording transcript. Generate comprehensive, well-organized notes.
 
-TRANSCRIPT ({duration_str}):
-{transcript}
+DEFAULT_WHISPER_CONCURRENCY = 8
+
+
+def whisper_concurrency() -> int:
+    """Read WHISPER_CONCURRENCY, falling back to the default if it is unset
+    or not a positive integer."""
+    value = os.environ.get('WHISPER_CONCURRENCY')
+    if value is None:
+        return DEFAULT_WHISPER_CONCURRENCY
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        print(f"  Invalid WHISPER_CONCURRENCY {value!r}, using {DEFAULT_WHISPER_CONCURRENCY}", file=sys.stderr)
+        return DEFAULT_WHISPER_CONCURRENCY
+    return concurrency
+
+
+def transcribe(chunk_queue: queue.Queue, progress_callback=None,
+               concurrency: int = DEFAULT_WHISPER_CONCURRENCY) -> str:
+    """Transcribe chunks from chunk_queue as they arrive, using a local
+    faster-whisper model if one is enabled and the OpenAI Whisper API
+    otherwise, with up to concurrency API requests in flight."""
+    model = local_whisper_model()
+    if model is not None:
+        # The model batches within each chunk and already keeps the
+        # hardware busy, so chunks are transcribed one at a time
+        transcribe_one = functools.partial(transcribe_chunk_locally, model=model)
+        max_workers = 1
+    else:
+        transcribe_one = functools.partial(transcribe_chunk, client=whisper_client())
+        # Whisper calls are network-bound, so transcribe chunks in parallel.
+        # Concurrency is capped to stay under the API's per-key rate limits.
+        max_workers = concurrency
+    lock = threading.Lock()
+    completed = 0
+    # The chunk count is only known once ffmpeg has finished segmenting, so
+    # progress carries no total until then rather than one that keeps growing
+    total = 0
+
+    def run(chunk_path: Path) -> str:
+        nonlocal completed
+        try:
+            return transcribe_one(chunk_path)
+        finally:
+            chunk_path.unlink(missing_ok=True)
+            with lock:
+                completed += 1
+                if progress_callback:
+                    if total:
+                        progress_callback('transcribing', f'Transcribed chunk {completed} of {total}', completed, total)
+                    else:
+                        progress_callback('transcribing', f'Transcribed chunk {completed}')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Futures are kept in submission order so transcripts stay in source order
+        futures = []
+        while (chunk_path := chunk_queue.get()) is not None:
+            futures.append(executor.submit(run, chunk_path))
+            if progress_callback:
+                progress_callback('transcribing', f'Transcribing chunk {len(futures)}...')
+        with lock:
+            total = len(futures)
+            if progress_callback and futures:
+                progress_callback('transcribing', f'Transcribed chunk {completed} of {total}', completed, total)
+        transcripts = [future.result() for future in futures]
+
+    # Combine transcripts
+    return "\n\n".join(transcript for transcript in transcripts if transcript)
+
+
+NOTES_MODEL = 'claude-sonnet-4-20250514'
+# Short recordings are summarized just as well by Haiku at about a quarter
+# of the price
+SHORT_NOTES_MODEL = 'claude-3-5-haiku-20241022'
+SHORT_TRANSCRIPT_CHARS = 5000
+# (input, output) USD per million tokens
+MODEL_PRICES = {
+    NOTES_MODEL: (3.00, 15.00),
+    SHORT_NOTES_MODEL: (0.80, 4.00),
+}
+# Bump whenever the notes prompt or sampling parameters change so cached
+# notes are regenerated
+PROMPT_VERSION = 4
+NOTES_CACHE_DIR = Path('~/.cache/videosum/notes').expanduser()
+
+# The transcript is sent first, as its own content block, so the cached
+# prompt prefix is the transcript alone. It stays reusable when the
+# instructions or the duration line change.
+NOTES_PROMPT = """Above is {source} of a class recording ({duration_str}). Generate comprehensive, well-organized notes.
 
 Create detailed notes with these sections:
 
@@ -209,47 +627,209 @@ Bullet points of the most important takeaways.
 
 Be detailed and capture the essence of the class. Do NOT include timestamps or speaker labels.
 Format as clean Markdown."""
+
+# Transcripts longer than this (about 80k tokens, or 7+ hours of speech)
+# are first outlined part by part with the cheaper model. The notes are
+# then written from the outlines, keeping the main call well inside the
+# context window and its input bill bounded.
+LONG_TRANSCRIPT_CHARS = 320_000
+OUTLINE_PART_CHARS = 32_000
+OUTLINE_CONCURRENCY = 4
+OUTLINE_PROMPT = """Above is one part of a longer class recording transcript. Outline it in detail as Markdown bullets, keeping:
+- each concept taught, with its explanation
+- stories and examples, with the lesson each one illustrates
+- exercises and practices, with their purpose and steps
+- notable insights
+
+Do NOT include timestamps or speaker labels."""
+
+
+@functools.lru_cache(maxsize=1)
+def notes_client() -> 'Anthropic':
+    """Return the shared Anthropic client used for notes generation."""
+    from anthropic import Anthropic
+    return Anthropic(max_retries=API_MAX_RETRIES)
+
+
+# The client's retries only cover the initial response. An overloaded_error
+# event partway through a stream arrives after a 200 status, so the streamed
+# notes call gets a few attempts of its own.
+NOTES_STREAM_ATTEMPTS = 3
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether an Anthropic error is worth retrying: rate limits, overload
+    and server errors, including overloaded_error events mid-stream."""
+    from anthropic import APIStatusError
+
+    if not isinstance(error, APIStatusError):
+        return False
+    if error.status_code in (429, 529) or error.status_code >= 500:
+        return True
+    body = error.body if isinstance(error.body, dict) else {}
+    details = body.get('error') if isinstance(body.get('error'), dict) else body
+    return details.get('type') == 'overloaded_error'
+
+
+def with_backoff(call, should_retry, attempts: int):
+    """Return call(), retrying errors should_retry accepts with exponential backoff."""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except Exception as error:
+            if attempt == attempts - 1 or not should_retry(error):
+                raise
+            # Jitter so concurrent runs don't retry in lockstep
+            time.sleep(2 ** attempt + random.random())
+
+
+def prewarm_notes_client():
+    """Import the Anthropic SDK and open a connection while Whisper is still
+    running, so the notes request doesn't wait on either."""
+    try:
+        notes_client().models.list(limit=1)
+    except Exception:
+        pass  # Only an optimization; generate_notes surfaces real errors
+
+
+def usage_cost(model: str, usage) -> float:
+    """Return the USD cost of a Claude response's token usage. Prompt cache
+    writes cost 1.25x the input price and cache reads 0.1x."""
+    input_price, output_price = MODEL_PRICES[model]
+    input_cost = (usage.input_tokens / 1_000_000) * input_price
+    input_cost += ((usage.cache_creation_input_tokens or 0) / 1_000_000) * input_price * 1.25
+    input_cost += ((usage.cache_read_input_tokens or 0) / 1_000_000) * input_price * 0.1
+    output_cost = (usage.output_tokens / 1_000_000) * output_price
+    return input_cost + output_cost
+
+
+def split_transcript(transcript: str, max_chars: int) -> list[str]:
+    """Split a transcript into parts of at most max_chars, breaking only
+    between paragraphs (a paragraph longer than max_chars is kept whole)."""
+    parts = []
+    paragraphs = []
+    length = 0
+    for paragraph in transcript.split('\n\n'):
+        if paragraphs and length + len(paragraph) > max_chars:
+            parts.append('\n\n'.join(paragraphs))
+            paragraphs = []
+            length = 0
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    if paragraphs:
+        parts.append('\n\n'.join(paragraphs))
+    return parts
+
+
+def outline_part(part: str) -> tuple[str, float]:
+    """Outline one part of a long transcript. Returns (outline, cost)."""
+    response = notes_client().messages.create(
+        model=SHORT_NOTES_MODEL,
+        max_tokens=4096,
+        temperature=0,
+        messages=[{
+            'role': 'user',
+            'content': [
+                {'type': 'text', 'text': part},
+                {'type': 'text', 'text': OUTLINE_PROMPT},
+            ]
         }]
     )
-
-    # Cost calculation (Claude Sonnet pricing)
-    input_cost = (response.usage.input_tokens / 1_000_000) * 3.00
-    output_cost = (response.usage.output_tokens / 1_000_000) * 15.00
-    cost = input_cost + output_cost
-
-    return response.content[0].text, cost
-
-
-def transcript_to_html(transcript: str, title: str, duration_seconds: int) -> str:
-    """Convert raw transcript to readable HTML with styling."""
-    # Split transcript into paragraphs (double newlines or very long sections)
-    paragraphs = transcript.split('\n\n')
-
-    # If only one paragraph, try to split on sentence boundaries for readability
-    if len(paragraphs) <= 2:
-        # Split long text into chunks of ~500 chars at sentence boundaries
-        chunks = []
-        current_chunk = ""
-        sentences = re.split(r'(?<=[.!?])\s+', transcript)
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) > 500:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence
-            else:
-                current_chunk += " " + sentence
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        paragraphs = chunks
-
-    html_paragraphs = [f'<p>{p.strip()}</p>' for p in paragraphs if p.strip()]
-    html_body = '\n'.join(html_paragraphs)
+    return response.content[0].text, usage_cost(SHORT_NOTES_MODEL, response.usage)
+
+
+def generate_notes(transcript: str, duration_seconds: int, notes_path: Path) -> tuple[str, float, bool]:
+    """Generate notes using Claude, streaming them into notes_path as they
+    are produced. Returns (markdown_notes, cost, cache_hit).
+
+    Notes are cached by transcript, model and prompt version, so
+    regenerating notes for an unchanged transcript costs nothing. Sampling
+    at temperature 0 is not guaranteed to be deterministic, so a cached
+    result is an equivalent set of notes rather than exactly what a fresh
+    call would produce. With VIDEOSUM_CACHE=0 the cache is not read, but
+    fresh notes still replace the cached copy.
+
+    Very long transcripts are summarized map-reduce style: parts are
+    outlined in parallel and the notes are written from the outlines.
+    """
+    model = SHORT_NOTES_MODEL if len(transcript) < SHORT_TRANSCRIPT_CHARS else NOTES_MODEL
+    cache_path = NOTES_CACHE_DIR / f"{hashlib.sha256(transcript.encode()).hexdigest()[:32]}.json"
+    if os.environ.get('VIDEOSUM_CACHE') != '0':
+        try:
+            cached = json.loads(cache_path.read_text())
+            if cached['model'] == model and cached['prompt_version'] == PROMPT_VERSION:
+                write_text_atomic(notes_path, cached['notes'])
+                return cached['notes'], 0.0, True
+        except (json.JSONDecodeError, KeyError, IOError):
+            pass
+
+    client = notes_client()
 
     hours = int(duration_seconds // 3600)
     minutes = int((duration_seconds % 3600) // 60)
     duration_str = f"{hours}h {minutes}m" if hours > 0 else f"{minutes}m"
 
-    return f"""<!DOCTYPE html>
+    source, source_desc, cost = transcript, 'the transcript', 0.0
+    if len(transcript) > LONG_TRANSCRIPT_CHARS:
+        parts = split_transcript(transcript, OUTLINE_PART_CHARS)
+        with ThreadPoolExecutor(max_workers=OUTLINE_CONCURRENCY) as executor:
+            outlines = list(executor.map(outline_part, parts))
+        source = '\n\n'.join(f'## Part {i}\n{outline}' for i, (outline, _) in enumerate(outlines, 1))
+        source_desc = 'a part-by-part outline of the transcript'
+        cost = sum(outline_cost for _, outline_cost in outlines)
+
+    def stream_notes():
+        # Each attempt reopens notes.md, discarding any partial output
+        with client.messages.stream(
+            model=model,
+            max_tokens=8192,
+            temperature=0,
+            messages=[{
+                'role': 'user',
+                'content': [
+                    # Marking the source cacheable lets a retry or regeneration
+                    # within a few minutes reuse it at a tenth of the input price
+                    {'type': 'text', 'text': source, 'cache_control': {'type': 'ephemeral'}},
+                    {'type': 'text', 'text': NOTES_PROMPT.format(source=source_desc, duration_str=duration_str)},
+                ]
+            }]
+        ) as stream, open(notes_path, 'w') as f:
+            # Write tokens as they arrive so notes.md fills in while Claude is
+            # still generating instead of appearing all at once at the end
+            for text in stream.text_stream:
+                f.write(text)
+            return stream.get_final_message()
+
+    response = with_backoff(stream_notes, _is_transient, NOTES_STREAM_ATTEMPTS)
+
+    cost += usage_cost(model, response.usage)
+
+    notes = response.content[0].text
+    try:
+        NOTES_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        write_text_atomic(cache_path, json.dumps({
+            'model': model,
+            'prompt_version': PROMPT_VERSION,
+            'notes': notes,
+            'usage': {
+                'input_tokens': response.usage.input_tokens,
+                'output_tokens': response.usage.output_tokens
+            }
+        }))
+    except IOError:
+        pass  # The cache is only an optimization
+    return notes, cost, False
+
+
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+_H1_RE = re.compile(r'^# (.+)$', re.MULTILINE)
+_HEADING_RE = re.compile(r'(#{1,3}) (.+)')
+_INLINE_RE = re.compile(r'\*\*(.+?)\*\*|\*(.+?)\*')
+_OL_ITEM_RE = re.compile(r'\d+\. (.+)')
+_HR_RE = re.compile(r'---+')
+
+
+TRANSCRIPT_HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -321,45 +901,104 @@ def transcript_to_html(transcript: str, title: str, duration_seconds: int) -> st
 </html>"""
 
 
-def markdown_to_html(markdown: str, title: str) -> str:
-    """Convert markdown to self-contained HTML with styling."""
-    html_body = markdown
-
-    # Convert headers
-    html_body = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html_body, flags=re.MULTILINE)
-    html_body = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html_body, flags=re.MULTILINE)
-    html_body = re.sub(r'^# (.+)$', r'<h1>\1</h1>', html_body, flags=re.MULTILINE)
-
-    # Convert bold and italic
-    html_body = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html_body)
-    html_body = re.sub(r'\*(.+?)\*', r'<em>\1</em>', html_body)
-
-    # Convert bullet lists
-    html_body = re.sub(r'^- (.+)$', r'<li>\1</li>', html_body, flags=re.MULTILINE)
+def _split_sentences(text: str, max_chars: int = 500) -> list[str]:
+    """Split text into chunks of about max_chars at sentence boundaries.
 
-    # Wrap consecutive <li> tags in <ul>
-    html_body = re.sub(r'((?:<li>.*?</li>\n?)+)', r'<ul>\1</ul>', html_body)
+    Sentences are joined once per chunk; growing a string with += is
+    quadratic on long transcripts.
+    """
+    chunks = []
+    parts = []
+    current_len = 0
+    for sentence in _SENTENCE_RE.split(text):
+        if current_len + len(sentence) > max_chars:
+            if parts:
+                chunks.append(' '.join(parts))
+            parts = [sentence]
+            current_len = len(sentence)
+        else:
+            parts.append(sentence)
+            current_len += len(sentence) + 1
+    if parts:
+        chunks.append(' '.join(parts))
+    return chunks
 
-    # Convert numbered lists
-    html_body = re.sub(r'^\d+\. (.+)$', r'<li>\1</li>', html_body, flags=re.MULTILINE)
 
-    # Convert horizontal rules
-    html_body = re.sub(r'^---+$', r'<hr>', html_body, flags=re.MULTILINE)
+def transcript_to_html(transcript: str, title: str, duration_seconds: int) -> str:
+    """Convert raw transcript to readable HTML with styling."""
+    # Chunk transcripts are separated by blank lines, but each 5 minute chunk
+    # is several thousand characters, so long paragraphs are also split on
+    # sentence boundaries for readability
+    paragraphs = [
+        chunk
+        for paragraph in transcript.split('\n\n')
+        for chunk in (_split_sentences(paragraph) if len(paragraph) > 500 else [paragraph])
+    ]
 
-    # Convert paragraphs (double newlines)
-    paragraphs = html_body.split('\n\n')
-    processed = []
-    for p in paragraphs:
-        p = p.strip()
-        if p and not p.startswith('<'):
-            p = f'<p>{p}</p>'
-        processed.append(p)
-    html_body = '\n'.join(processed)
+    html_body = '\n'.join(f'<p>{p}</p>' for p in map(str.strip, paragraphs) if p)
 
-    # Replace single newlines within paragraphs with <br>
-    html_body = re.sub(r'(?<!>)\n(?!<)', '<br>\n', html_body)
+    hours = int(duration_seconds // 3600)
+    minutes = int((duration_seconds % 3600) // 60)
+    duration_str = f"{hours}h {minutes}m" if hours > 0 else f"{minutes}m"
 
-    return f"""<!DOCTYPE html>
+    return TRANSCRIPT_HTML_TEMPLATE.format(title=title, duration_str=duration_str, html_body=html_body)
+
+
+def _inline_html(match: re.Match) -> str:
+    bold, italic = match.groups()
+    return f'<strong>{bold}</strong>' if bold is not None else f'<em>{italic}</em>'
+
+
+def _markdown_to_html_body(markdown: str) -> str:
+    """Convert markdown to an HTML fragment.
+
+    Handles the subset Claude's notes use (headers, bullet and numbered
+    lists, rules, bold and italic) in a single pass over the lines.
+    """
+    out = []
+    paragraph = []
+    list_tag = None
+
+    def close_blocks():
+        nonlocal list_tag
+        if paragraph:
+            out.append('<p>' + '<br>\n'.join(paragraph) + '</p>')
+            paragraph.clear()
+        if list_tag:
+            out.append(f'</{list_tag}>')
+            list_tag = None
+
+    def add_list_item(tag: str, text: str):
+        nonlocal list_tag
+        if list_tag != tag:
+            close_blocks()
+            out.append(f'<{tag}>')
+            list_tag = tag
+        out.append(f'<li>{_INLINE_RE.sub(_inline_html, text)}</li>')
+
+    for line in markdown.splitlines():
+        if not line.strip():
+            close_blocks()
+        elif line.startswith('- '):
+            add_list_item('ul', line[2:])
+        elif match := _OL_ITEM_RE.match(line):
+            add_list_item('ol', match.group(1))
+        elif match := _HEADING_RE.match(line):
+            close_blocks()
+            level = len(match.group(1))
+            out.append(f'<h{level}>{_INLINE_RE.sub(_inline_html, match.group(2))}</h{level}>')
+        elif _HR_RE.fullmatch(line):
+            close_blocks()
+            out.append('<hr>')
+        else:
+            if list_tag:
+                close_blocks()
+            paragraph.append(_INLINE_RE.sub(_inline_html, line))
+    close_blocks()
+    return '\n'.join(out)
+
+
+NOTES_HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -437,17 +1076,44 @@ def markdown_to_html(markdown: str, title: str) -> str:
 </html>"""
 
 
+def markdown_to_html(markdown: str, title: str) -> str:
+    """Convert markdown to self-contained HTML with styling.
+
+    Not currently called by process_video or the app.
+    """
+    return NOTES_HTML_TEMPLATE.format(title=title, html_body=_markdown_to_html_body(markdown))
+
+
+_progress_lock = threading.Lock()
+
+
 def emit_progress(step: str, message: str, progress: int = 0, total: int = 0):
-    """Emit a structured progress message for the frontend."""
-    data = {'step': step, 'message': message}
+    """Emit a structured progress message for the frontend. Safe to call from worker threads."""
+    # Format the JSON directly rather than building a dict for json.dumps;
+    # encode_basestring_ascii is the C string escaper json.dumps uses
+    line = f'PROGRESS:{{"step": {encode_basestring_ascii(step)}, "message": {encode_basestring_ascii(message)}'
     if total > 0:
-        data['progress'] = progress
-        data['total'] = total
-    print(f"PROGRESS:{json.dumps(data)}", file=sys.stderr, flush=True)
+        line += f', "progress": {int(progress)}, "total": {int(total)}'
+    with _progress_lock:
+        sys.stderr.write(line + '}\n')
+        sys.stderr.flush()
+
+
+_UNSAFE_FOLDER_CHARS_RE = re.compile(r'[^\w\-]')
+
+
+def load_env():
+    """Load environment variables from .env.local or .env."""
+    env_path = Path(__file__).parent.parent / '.env.local'
+    if not env_path.exists():
+        env_path = Path(__file__).parent.parent / '.env'
+    load_dotenv(env_path)
 
 
-def process_video(video_path: str, output_base: str) -> dict:
-    """Main processing function."""
+def process_video(video_path: str, output_base: str, full_hash: bool = False) -> dict:
+    """Main processing function. With full_hash, duplicates are detected by
+    hashing the entire video instead of sampling it."""
+    load_env()
     video_path = Path(video_path).expanduser().resolve()
     output_base = Path(output_base).expanduser().resolve()
 
@@ -455,18 +1121,20 @@ def process_video(video_path: str, output_base: str) -> dict:
         raise FileNotFoundError(f"Video not found: {video_path}")
 
     # Check for required environment variables
-    if not os.environ.get('OPENAI_API_KEY'):
+    if not os.environ.get('OPENAI_API_KEY') and not local_whisper_available():
         raise EnvironmentError("OPENAI_API_KEY not set")
     if not os.environ.get('ANTHROPIC_API_KEY'):
         raise EnvironmentError("ANTHROPIC_API_KEY not set")
+    # Read before extraction starts, so a bad value can't strand chunks
+    concurrency = whisper_concurrency()
 
     # Create output directory
     output_base.mkdir(parents=True, exist_ok=True)
 
     # Check for duplicates
     emit_progress('checking', 'Checking for duplicates...')
-    file_hash = get_file_hash(video_path)
-    existing = check_already_processed(output_base, file_hash)
+    hash_scheme = 'sha256' if full_hash else DEFAULT_HASH_SCHEME
+    file_hash, existing = check_already_processed(output_base, video_path, hash_scheme)
     if existing:
         return {
             'status': 'duplicate',
@@ -478,41 +1146,54 @@ def process_video(video_path: str, output_base: str) -> dict:
     # Create output folder
     timestamp = datetime.now().strftime('%Y-%m-%d')
     # Clean filename for folder name
-    clean_name = re.sub(r'[^\w\-]', '-', video_path.stem[:30])
+    clean_name = _UNSAFE_FOLDER_CHARS_RE.sub('-', video_path.stem[:30])
     folder_name = f"{timestamp}-{clean_name}"
     output_folder = output_base / folder_name
     output_folder.mkdir(exist_ok=True)
 
     emit_progress('extracting', f'Extracting audio from {video_path.name}...')
 
-    # Extract audio
-    audio_path = output_folder / 'audio.mp3'
-    duration = extract_audio(video_path, audio_path)
+    # Extract audio and transcribe as a pipeline: each chunk is sent to
+    # Whisper as soon as ffmpeg finishes writing it
+    chunk_queue = queue.Queue()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        extraction = executor.submit(extract_audio, video_path, output_folder, chunk_queue)
+        executor.submit(prewarm_notes_client)
+        emit_progress('transcribing', 'Starting transcription with Whisper...')
+        transcript = transcribe(chunk_queue, emit_progress, concurrency)
+        duration = extraction.result()
+    if not transcript:
+        # Every chunk was too short or silent to transcribe
+        raise RuntimeError(f"No speech found in {video_path.name}")
+    # Cost: $0.006 per minute. Chunk sizes no longer track duration now that
+    # audio is Opus-encoded with silences removed, so estimate from duration.
+    # Local transcription is free.
+    transcription_cost = 0.0 if local_whisper_model() else duration / 60 * 0.006
     duration_min = int(duration // 60)
-    emit_progress('extracting', f'Audio extracted ({duration_min} minutes)')
+    emit_progress('transcribing', f'Transcription complete ({duration_min} minutes, {len(transcript):,} characters)')
 
-    # Transcribe
-    emit_progress('transcribing', 'Starting transcription with Whisper...')
-    transcript, transcription_cost = transcribe(audio_path, emit_progress)
-    (output_folder / 'transcript.txt').write_text(transcript)
-    emit_progress('transcribing', f'Transcription complete ({len(transcript):,} characters)')
-
-    # Generate summary notes
+    # Generate summary notes in the background. The transcript files don't
+    # depend on the notes, so they are written while Claude is working.
     emit_progress('summarizing', 'Generating summary notes with Claude...')
-    notes_md, summarization_cost = generate_notes(transcript, int(duration))
-    (output_folder / 'notes.md').write_text(notes_md)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        notes_future = executor.submit(generate_notes, transcript, int(duration), output_folder / 'notes.md')
+
+        write_text_atomic(output_folder / 'transcript.txt', transcript)
+        # Generate HTML transcript (viewable in browser), titled after the
+        # video file until the notes provide a better title
+        html = transcript_to_html(transcript, video_path.stem, int(duration))
+        write_text_atomic(output_folder / 'transcript.html', html)
+
+        notes_md, summarization_cost, notes_cache_hit = notes_future.result()
 
     # Extract title from notes (first H1)
-    title_match = re.search(r'^# (.+)$', notes_md, re.MULTILINE)
+    title_match = _H1_RE.search(notes_md)
     title = title_match.group(1) if title_match else video_path.stem
 
-    # Generate HTML transcript (viewable in browser)
-    emit_progress('finalizing', 'Generating HTML transcript...')
-    html = transcript_to_html(transcript, title, int(duration))
-    (output_folder / 'transcript.html').write_text(html)
-
-    # Clean up audio file (saves disk space)
-    audio_path.unlink()
+    if title != video_path.stem:
+        emit_progress('finalizing', 'Generating HTML transcript...')
+        html = transcript_to_html(transcript, title, int(duration))
+        write_text_atomic(output_folder / 'transcript.html', html)
 
     # Save metadata
     total_cost = transcription_cost + summarization_cost
@@ -520,15 +1201,20 @@ def process_video(video_path: str, output_base: str) -> dict:
         'title': title,
         'source_file': video_path.name,
         'source_hash': file_hash,
+        'hash_scheme': hash_scheme,
         'duration_seconds': int(duration),
         'processed_at': datetime.now().isoformat(),
         'costs': {
             'transcription': round(transcription_cost, 4),
             'summarization': round(summarization_cost, 4),
             'total': round(total_cost, 4)
-        }
+        },
+        'notes_cache_hit': notes_cache_hit
     }
-    (output_folder / 'metadata.json').write_text(json.dumps(metadata, indent=2))
+    # metadata.json marks the folder as processed, so it is written last
+    write_text_atomic(output_folder / 'metadata.json', json.dumps(metadata, indent=2))
+
+    update_index(output_base, file_hash, output_folder.name, hash_scheme)
 
     emit_progress('complete', f'Done! Cost: ${total_cost:.2f}')
 
@@ -542,14 +1228,16 @@ def process_video(video_path: str, output_base: str) -> dict:
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python3 process_video.py <video_path> <output_dir>", file=sys.stderr)
+    full_hash = '--full-hash' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--full-hash']
+    if len(args) != 2:
+        print("Usage: python3 process_video.py <video_path> <output_dir> [--full-hash]", file=sys.stderr)
         print("\nExample:", file=sys.stderr)
         print("  python3 process_video.py ~/Videos/class.mp4 ~/ClassNotes", file=sys.stderr)
         sys.exit(1)
 
     try:
-        result = process_video(sys.argv[1], sys.argv[2])
+        result = process_video(args[0], args[1], full_hash=full_hash)
         print(json.dumps(result))
     except Exception as e:
         print(json.dumps({'status': 'error', 'message': str(e)}))